@@ -40,7 +40,9 @@ import functools
 import logging
 import operator
 import os
+import signal
 import sys
+import threading
 from http.client import HTTPConnection
 
 import logzero
@@ -50,6 +52,7 @@ from logzero import logger
 
 import emojifs
 import emojifs.slack
+import emojifs.utils as utils
 from emojifs.muxer import Muxer
 from emojifs.slack import Slack
 from emojifs.discord import Discord
@@ -69,6 +72,78 @@ def _get(tree, branches, *, default=None):
         return default
 
 
+def _build_muxer_map(config, filesystems):
+    """Construct all the Slacks and Discords described by config, and return a map of them
+    suitable for Muxer.  filesystems is a dict of previously-constructed filesystems, keyed by
+    their secrets; we reuse those when possible (keeping their caches warm), and add any new ones.
+    """
+    muxer_map = {}
+    if 'slack' in config:
+        slacks = {}
+        slack_renames = _get(config, ['slack', 'renames'], default={})
+
+        # TODO: maybe allow parsing a single string cookie from those sections? (or token?)
+
+        def _add_slack_from_token(token: str):
+            """Given a token, construct a Slack, fetch its associated name, then apply any
+            name remappings, and stash it in our Slacks dict."""
+            if ('slack', token) not in filesystems:
+                filesystems[('slack', token)] = Slack(token=token)
+            s = filesystems[('slack', token)]
+            our_name = slack_renames.get(s.name, s.name)
+            if our_name not in slacks:
+                slacks[our_name] = s
+                logger.debug("Added slack '%s' as '%s'", s.name, our_name)
+
+        for t in _get(config, ['slack', 'tokens'], default=[]):
+            _add_slack_from_token(t)
+
+        for c in _get(config, ['slack', 'cookies'], default=[]):
+            logger.info('🔑 trying Slack login cookie scrape... 🥠')
+            tokens = emojifs.slack.enumerate_tokens(c)
+            for t in tokens:
+                _add_slack_from_token(t)
+
+        # assemble a slack_mounts dict to be passed to Muxer
+        muxer_map = {f"/slack/{our_name}": s for (our_name, s) in slacks.items()}
+
+    if 'discord' in config:
+        ack = _get(config, ['discord', 'acknowledged'])
+        token = _get(config, ['discord', 'token'])
+        if token:
+            ACKSPECTED = "I understand that using this program violates Discord's ToS"
+            if ack != ACKSPECTED:
+                logger.error("⚠️  Using this program violates Discord's Terms of Service and could"
+                             " potentially result in your account being banned.  For details, see "
+                             "https://support.discord.com/hc/en-us/articles/115002192352  "
+                             "If you accept the risk, add this to your config under [discord]:"
+                             "\nacknowledged = \"%s\"", ACKSPECTED)
+                logger.error("Not mounting /discord as you didn't acknowledge the risk.")
+            else:
+                prefetch_sizes = _get(config, ['discord', 'prefetch_sizes'], default=False)
+                key = ('discord', token, prefetch_sizes)
+                if key not in filesystems:
+                    filesystems[key] = Discord(token, prefetch_sizes=prefetch_sizes)
+                muxer_map['/discord'] = filesystems[key]
+
+    return muxer_map
+
+
+def _start_signal_thread(handlers):
+    """Start a daemon thread that calls handlers[signum]() whenever it receives one of the signals
+    in handlers, which must already be blocked in all threads.
+
+    We can't just use signal.signal(): Python only runs those handlers on the main thread, which
+    spends the whole time we're mounted inside libfuse's main loop.  This must be started after
+    mounting (e.g. from the FUSE init operation), as libfuse might fork to daemonize us first, and
+    threads don't survive a fork."""
+    def loop():
+        while True:
+            signum = signal.sigwait(handlers)
+            handlers[signum]()
+    threading.Thread(target=loop, name='emojifs-signals', daemon=True).start()
+
+
 def main():
     p = argparse.ArgumentParser(
         prog='emojifs',
@@ -114,53 +189,37 @@ def main():
                      'or on the command line 😬')
         sys.exit(1)
 
-    muxer_map = {}
-    if 'slack' in config:
-        slacks = {}
-        slack_renames = _get(config, ['slack', 'renames'], default={})
-
-        # TODO: maybe allow parsing a single string cookie from those sections? (or token?)
-
-        def _add_slack_from_token(token: str):
-            """Given a token, construct a Slack, fetch its associated name, then apply any
-            name remappings, and stash it in our Slacks dict."""
-            s = Slack(token=t)
-            our_name = slack_renames.get(s.name, s.name)
-            if our_name not in slacks:
-                slacks[our_name] = s
-                logger.debug("Added slack '%s' as '%s'", s.name, our_name)
-
-        for t in _get(config, ['slack', 'tokens'], default=[]):
-            _add_slack_from_token(t)
-
-        for c in _get(config, ['slack', 'cookies'], default=[]):
-            logger.info('🔑 trying Slack login cookie scrape... 🥠')
-            tokens = emojifs.slack.enumerate_tokens(c)
-            for t in tokens:
-                _add_slack_from_token(t)
-
-        # assemble a slack_mounts dict to be passed to Muxer
-        muxer_map = {f"/slack/{our_name}": s for (our_name, s) in slacks.items()}
-
-    if 'discord' in config:
-        ack = _get(config, ['discord', 'acknowledged'])
-        token = _get(config, ['discord', 'token'])
-        if token:
-            ACKSPECTED = "I understand that using this program violates Discord's ToS"
-            if ack != ACKSPECTED:
-                logger.error("⚠️  Using this program violates Discord's Terms of Service and could"
-                             " potentially result in your account being banned.  For details, see "
-                             "https://support.discord.com/hc/en-us/articles/115002192352  "
-                             "If you accept the risk, add this to your config under [discord]:"
-                             "\nacknowledged = \"%s\"", ACKSPECTED)
-                logger.error("Not mounting /discord as you didn't acknowledge the risk.")
-            else:
-                muxer_map['/discord'] = Discord(token)
+    filesystems = {}
+    muxer_map = _build_muxer_map(config, filesystems)
 
     if not muxer_map:
         logger.warn("We didn't discover any Slacks or Discords to use. "
                     "Check your configuration file for errors?")
-    mux = Muxer(muxer_map)
+
+    def invalidate():
+        logger.info('🧹 Invalidating all caches')
+        mux.invalidate_caches()
+        utils.invalidate_caches()
+
+    def reload():
+        logger.info('🔄 Reloading config file %s', args.config.name)
+        try:
+            with open(args.config.name) as f:
+                new_config = tomlkit.parse(f.read())
+            mux.remap(_build_muxer_map(new_config, filesystems))
+        except Exception:
+            logger.error('😖 Something went wrong reloading the config file', exc_info=True)
+
+    # Block the signals we handle ourselves *before* FUSE starts any threads, so that every thread
+    # inherits the mask and the signals are only ever received by the sigwait() in the thread
+    # _start_signal_thread starts.
+    # (This also stops libfuse from treating SIGHUP as a request to unmount.)
+    on_init = None
+    if hasattr(signal, 'pthread_sigmask'):  # i.e. not on Windows
+        handlers = {signal.SIGUSR1: invalidate, signal.SIGHUP: reload}
+        signal.pthread_sigmask(signal.SIG_BLOCK, handlers)
+        on_init = functools.partial(_start_signal_thread, handlers)
+    mux = Muxer(muxer_map, on_init=on_init)
 
     foreground = args.foreground or _get(config, ['emojifs', 'foreground'], default=False)
     if args.verbose >= 1 and not foreground:
@@ -173,9 +232,5 @@ def main():
         logger.error('😖 Something went wrong in FUSE setup', exc_info=True)
 
 
-# TODO: signal handler (USR1?) to invalidate the TTL caches of all things
-
-# TODO: SIGHUP to re-load config and adjust as necessary?
-
 if __name__ == '__main__':
     main()
@@ -20,9 +20,10 @@ along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 import base64
 import errno
-import io
+import functools
 import operator
 import stat
+import threading
 import time
 
 import cachetools
@@ -38,16 +39,41 @@ class Discord(fuse.LoggingMixIn, fuse.Operations):
     """A FUSE filesystem implementation for a Discord user's guilds' emojis."""
 
     _base_url = 'https://discord.com/api/v6/'
+    _upload_extensions = ('jpg', 'jpeg', 'gif', 'png')
 
-    def __init__(self, token: str):
+    def __init__(self, token: str, *, prefetch_sizes: bool = False):
+        """Given an authentication token, construct a Discord instance.
+
+        If prefetch_sizes is set, listing a guild's directory will also concurrently fetch the
+        sizes of all its emoji, which makes a subsequent `ls -l` much faster (at the cost of
+        many more requests to Discord's CDN when you just wanted `ls`)."""
+        self._prefetch_sizes = prefetch_sizes
         self._retry_after = {}  # URL -> time.time() after which it's ok to retry
-        self._write_buffers = {}  # path (not name!) -> BytesIO
+        self._write_buffers = {}  # path (not name!) -> bytearray
 
         # emoji metadata for 100 guilds + 1 guild membership list
         self._emojis_cache = cachetools.TTLCache(maxsize=100, ttl=600)
         self._membership_cache = cachetools.TTLCache(maxsize=1, ttl=600)
+        self._guilds_by_path = {}  # rendered guild path -> guild; rebuilt by _get_guilds()
+        # emoji ID -> size in bytes, so that stat()ing a whole guild doesn't HEAD every emoji
+        self._size_cache = cachetools.TTLCache(maxsize=4096, ttl=3600)
+        self._size_lock = threading.Lock()  # readdir's prefetch writes to it from another thread
+        # path -> (guild, emoji), very briefly, as the kernel often stat()s right before a read()
+        self._path_resolve_cache = cachetools.TTLCache(maxsize=1024, ttl=1)
+        # FUSE calls us from many threads at once, and TTLCaches aren't thread-safe.
+        self._path_resolve_lock = threading.Lock()
+
+        # The parts of getattr() results that never change.
+        self._dir_attr_template = dict(st_nlink=2, st_uid=utils.getuid(), st_gid=utils.getgid())
+        self._file_attr_template = dict(st_nlink=1, st_uid=utils.getuid(), st_gid=utils.getgid())
+        self._root_attr_template = dict(self._dir_attr_template,
+                                        st_mode=stat.S_IFDIR | 0o555 | stat.S_IWUSR)
 
         self._session = requests.Session()
+        # Enough pooled keep-alive connections that concurrent FUSE operations (to both the API
+        # and the CDN) don't each have to set up a new TLS connection.
+        self._session.mount('https://', requests.adapters.HTTPAdapter(
+            pool_connections=32, pool_maxsize=64, max_retries=0))
         utils.set_user_agent(self._session.headers)
         self._session.headers['Authorization'] = token
 
@@ -79,16 +105,17 @@ class Discord(fuse.LoggingMixIn, fuse.Operations):
         # TODO: this is very close to, but not quite, Slack._request().
         url = self._url(urlfrag)
 
-        # Attempt to respect any known ratelimiting on the given URL path
-        time.sleep(max(0, self._retry_after.get(url, 0) - time.time()))
-        resp = self._session.request(http_method, url, **kwargs)
-        if resp.status_code == 429:
-            self._retry_after[url] = time.time() + resp.headers.get('X-RateLimit-Reset-After', 60)
+        while True:
+            # Attempt to respect any known ratelimiting on the given URL path
+            time.sleep(max(0, self._retry_after.get(url, 0) - time.time()))
+            resp = self._session.request(http_method, url, **kwargs)
+            if resp.status_code != 429:
+                break
+            reset_after = float(resp.headers.get('X-RateLimit-Reset-After', 60))
+            self._retry_after[url] = time.time() + reset_after
             logger.warn('Got ratelimited by Discord; retrying after %s seconds for %s',
-                        self._retry_after[url], url)
-            return self._request(http_method, url, **kwargs)
-        else:
-            resp.raise_for_status()
+                        reset_after, url)
+        resp.raise_for_status()
         if resp.status_code == 204:
             logger.debug('resp for %s to %s: HTTP %s', http_method, url, resp.status_code)
         else:
@@ -99,21 +126,71 @@ class Discord(fuse.LoggingMixIn, fuse.Operations):
     def _get_guilds(self):
         '''Returns all the guilds we're a member of.'''
         j = self._request('GET', 'users/@me/guilds').json()
+        # Also (re)build the index used by _path_to_guild to match guilds by name.
+        # setdefault() so that, like before, the first of several same-named guilds wins.
+        by_path = {}
+        for g in j:
+            by_path.setdefault(self._guild_to_path(g), g)
+        self._guilds_by_path = by_path
         return {g['id']: g for g in j}
 
     # ⚠ If you change the signature of this function, you must also update _invalidate_guild!
     @cachetools.cachedmethod(operator.attrgetter('_emojis_cache'))
     def _get_emojis(self, id: str):
-        '''Returns all the emoji for a given guild.'''
+        '''Returns all the emoji for a given guild, indexed both 'by_name' and 'by_filename'.'''
         j = self._request('GET', f'guilds/{id}/emojis').json()
-        return {e['name']: e for e in j}
+        return {
+            'by_name': {e['name']: e for e in j},
+            'by_filename': {self._emoji_filename(e): e for e in j},
+        }
 
     def _invalidate_guild(self, id: str):
         '''Clear the cache of a given guild.'''
         # ⚠ The arguments given to hashkey() must be exactly the signature of _get_emojis().
-        k = cachetools.keys.hashkey(id)
-        if k in self._emojis_cache:
-            del self._emojis_cache[k]
+        self._emojis_cache.pop(cachetools.keys.hashkey(id), None)
+        # Any path in the guild might now resolve differently.
+        with self._path_resolve_lock:
+            self._path_resolve_cache.clear()
+
+    def invalidate_caches(self):
+        '''Clear all of our cached metadata and emoji sizes.  (Emoji bytes are cached, along with
+        everyone else's, by utils.get_emoji_bytes.)'''
+        self._membership_cache.clear()
+        self._emojis_cache.clear()
+        with self._size_lock:
+            self._size_cache.clear()
+        with self._path_resolve_lock:
+            self._path_resolve_cache.clear()
+
+    def _invalidate_emoji(self, e):
+        '''Clear any cached data about a given emoji.'''
+        utils.invalidate_url(self._emoji_url(e))
+        with self._size_lock:
+            self._size_cache.pop(e['id'], None)
+
+    def _emoji_size(self, e) -> int:
+        '''Returns the size in bytes of a given emoji, fetching it only if not already known.'''
+        with self._size_lock:
+            sz = self._size_cache.get(e['id'])
+        if sz is not None:
+            return sz
+        sz = utils.get_content_length(self._emoji_url(e))
+        with self._size_lock:
+            self._size_cache[e['id']] = sz
+        return sz
+
+    def _prefetch_emoji_sizes(self, emojis):
+        '''Concurrently fetch the sizes of any of the given emoji we don't already know.'''
+        with self._size_lock:
+            missing = {e['id']: self._emoji_url(e) for e in emojis
+                       if e['id'] not in self._size_cache}
+        if not missing:
+            return
+        sizes = utils.prefetch_content_lengths(missing.values())
+        with self._size_lock:
+            for (id, url) in missing.items():
+                if url in sizes:
+                    self._size_cache[id] = sizes[url]
 
     def _emoji_url(self, e):
         extension = 'gif' if e['animated'] else 'png'
@@ -136,41 +213,48 @@ class Discord(fuse.LoggingMixIn, fuse.Operations):
         if isinstance(g, dict):
             return self._guild_to_path(g['name'])
         if isinstance(g, str):
-            return g.replace('/', '_')
+            return self._name_to_path(g)
         raise ValueError
 
-    def _path_to_guild(self, path):
-        '''Given a /discord/foo/bar path, find the guild matching foo.'''
-        gh = path.split('/', maxsplit=2)[1]
-        guilds = self._get_guilds()
-        # Direct ID lookups
-        if gh in guilds:
-            return guilds[gh]
-        # TODO: alias support
-        # Match by names
-        candidates = [g for g in guilds.values() if gh == self._guild_to_path(g)]
-        if candidates:
-            return candidates[0]
-        return None
-
-    def _path_to_emojiname(self, path):
-        '''/discord/foo/bar.png --> bar'''
+    @staticmethod
+    @functools.lru_cache(maxsize=4096)
+    def _name_to_path(name: str) -> str:
+        return name.replace('/', '_')
+
+    @staticmethod
+    @functools.lru_cache(maxsize=4096)
+    def _parse_path(path):
+        '''/discord/foo/bar.png --> (foo, bar, png).  Missing components are None.'''
         split = path.split('/', maxsplit=2)
+        gh = split[1] if len(split) > 1 and split[1] else None
         if len(split) < 3 or not split[2]:
-            return None
-        # Strip off any file extension.
-        eh = split[2].split('.', maxsplit=1)[0]
-        return eh
+            return (gh, None, None)
+        # The emoji name is everything before the first dot; the extension after the last.
+        (eh, dot, rest) = split[2].partition('.')
+        ext = rest.rsplit('.', maxsplit=1)[-1] if dot else None
+        return (gh, eh, ext)
+
+    def _find_guild(self, gh):
+        '''Given the foo of a /discord/foo/bar path, find the guild matching it.'''
+        guilds = self._get_guilds()
+        # Direct ID lookups, then match by names
+        # TODO: alias support
+        return guilds.get(gh) or self._guilds_by_path.get(gh)
 
+    @cachetools.cachedmethod(operator.attrgetter('_path_resolve_cache'),
+                             lock=operator.attrgetter('_path_resolve_lock'))
     def _path_to_guildmoji(self, path):
         '''Given a /discord/foo/bar.png path, find and return (guild, emoji) objects.'''
-        g = self._path_to_guild(path)
+        (gh, eh, ext) = self._parse_path(path)
+        g = self._find_guild(gh)
         if g:
-            eh = self._path_to_emojiname(path)
             if eh:
                 emojis = self._get_emojis(g['id'])
-                if eh in emojis:
-                    return (g, emojis[eh])
+                # Prefer an exact match on the filename, then allow a missing or other extension.
+                e = ((ext and emojis['by_filename'].get(f"{eh}.{ext}"))
+                     or emojis['by_name'].get(eh))
+                if e:
+                    return (g, e)
                 else:
                     raise fuse.FuseOSError(errno.ENOENT)
             else:
@@ -184,55 +268,35 @@ class Discord(fuse.LoggingMixIn, fuse.Operations):
         return bool(g['permissions'] & MANAGE_EMOJIS)
 
     def getattr(self, path, fh):
+        now = time.time()
+        times = dict(st_atime=now, st_ctime=now, st_mtime=now)
+
         if path == '/':
-            return dict(
-                st_mode=stat.S_IFDIR | 0o555 | stat.S_IWUSR,
-                st_mtime=time.time(),
-                st_ctime=time.time(),
-                st_atime=time.time(),
-                st_nlink=2,
-                st_uid=utils.getuid(),
-                st_gid=utils.getgid(),
-            )
+            return {**self._root_attr_template, **times}
 
         if path in self._write_buffers:
-            return dict(
-                st_mode=stat.S_IFREG | 0o600,
-                st_atime=time.time(),
-                st_ctime=time.time(),
-                st_mtime=time.time(),
-                st_nlink=1,
-                st_uid=utils.getuid(),
-                st_gid=utils.getgid(),
-                st_size=len(self._write_buffers[path].getbuffer())
-            )
+            return {
+                **self._file_attr_template, **times,
+                'st_mode': stat.S_IFREG | 0o600,
+                'st_size': len(self._write_buffers[path]),
+            }
 
         # This will raise a Fuse ENOENT if a nonexistent emoji name was specified in the path
         (g, e) = self._path_to_guildmoji(path)
         if g is None:
             raise fuse.FuseOSError(errno.ENOENT)
         elif e is None:
-            return dict(
-                st_mode=stat.S_IFDIR | 0o555 | (stat.S_IWUSR if self._guild_is_writable(g)
-                                                else 0),
-                st_mtime=time.time(),
-                st_ctime=time.time(),
-                st_atime=time.time(),
-                st_nlink=2,
-                st_uid=utils.getuid(),
-                st_gid=utils.getgid(),
-            )
+            return {
+                **self._dir_attr_template, **times,
+                'st_mode': (stat.S_IFDIR | 0o555
+                            | (stat.S_IWUSR if self._guild_is_writable(g) else 0)),
+            }
         else:
-            return dict(
-                st_mode=stat.S_IFREG | 0o444,
-                st_atime=time.time(),
-                st_ctime=time.time(),
-                st_mtime=time.time(),
-                st_nlink=1,
-                st_uid=utils.getuid(),
-                st_gid=utils.getgid(),
-                st_size=utils.get_content_length(self._emoji_url(e))
-            )
+            return {
+                **self._file_attr_template, **times,
+                'st_mode': stat.S_IFREG | 0o444,
+                'st_size': self._emoji_size(e),
+            }
 
     def readdir(self, path, fh=None):
         rv = ['.', '..']
@@ -240,7 +304,10 @@ class Discord(fuse.LoggingMixIn, fuse.Operations):
             rv.extend(self._guild_to_path(g) for g in self._get_guilds().values())
         (g, e) = self._path_to_guildmoji(path)
         if g is not None and e is None:
-            rv.extend(self._emoji_filename(e) for e in self._get_emojis(g['id']).values())
+            emojis = self._get_emojis(g['id'])['by_filename']
+            if self._prefetch_sizes:
+                self._prefetch_emoji_sizes(emojis.values())
+            rv.extend(emojis)
         return rv
 
     def listxattr(self, path):
@@ -266,13 +333,13 @@ class Discord(fuse.LoggingMixIn, fuse.Operations):
 
     def read(self, path, size, offset, fh):
         if path in self._write_buffers:
-            b = self._write_buffers[path]
-            b.seek(offset)
-            return b.read(size)
+            return bytes(self._write_buffers[path][offset:offset+size])
 
         (g, e) = self._path_to_guildmoji(path)
         if g and e:
-            b = utils.get_emoji_bytes(self._emoji_url(e))
+            b = utils.get_emoji_bytes(self._emoji_url(e), 'http')
+            with self._size_lock:
+                self._size_cache[e['id']] = len(b)
             return b[offset:offset+size]
         else:
             raise fuse.FuseOSError(errno.ENOENT)
@@ -284,6 +351,7 @@ class Discord(fuse.LoggingMixIn, fuse.Operations):
             logger.info('🗑️ Deleting :%s: (id %s) from "%s" (id %s)',
                         e['name'], e['id'], g['name'], g['id'])
             self._request('DELETE', f"guilds/{g['id']}/emojis/{e['id']}")
+            self._invalidate_emoji(e)
             self._invalidate_guild(g['id'])
         elif g and not e:
             # Sorry, but we won't delete a whole discord.
@@ -291,51 +359,41 @@ class Discord(fuse.LoggingMixIn, fuse.Operations):
         else:
             raise fuse.FuseOSError(errno.ENOENT)
 
-    def _path_to_extension(self, path):
-        split = path.rsplit('.', maxsplit=1)
-        if len(split) < 2:
-            raise ValueError
-        extension = split[-1]
-        if extension.lower() not in ['jpg', 'jpeg', 'gif', 'png']:
-            raise ValueError
-        return extension
-
     def create(self, path, mode, fi=None):
-        g = self._path_to_guild(path)
+        (gh, eh, ext) = self._parse_path(path)
+        g = self._find_guild(gh)
         if not g:
             raise fuse.FuseOSError(errno.ENOENT)
         if not self._guild_is_writable(g):
             raise fuse.FuseOSError(errno.EPERM)
-        try:
-            self._path_to_extension(path)
-        except ValueError:
+        if not eh or not ext or ext.lower() not in self._upload_extensions:
             raise fuse.FuseOSError(errno.EINVAL)
-        self._write_buffers[path] = io.BytesIO()
+        self._write_buffers[path] = bytearray()
         return 0
 
     def write(self, path, data, offset, fh):
         b = self._write_buffers[path]
-        b.seek(offset)
-        return b.write(data)
+        end = offset + len(data)
+        if end > len(b):
+            # Grow the buffer (zero-filling any gap, like a sparse file) to fit the write.
+            b.extend(bytes(end - len(b)))
+        b[offset:end] = data
+        return len(data)
 
     def release(self, path, fh):
         if path in self._write_buffers:
             b = self._write_buffers[path]
-            b.seek(0)
-            g = self._path_to_guild(path)
-            eh = self._path_to_emojiname(path)
-            ext = self._path_to_extension(path)
+            (gh, eh, ext) = self._parse_path(path)
+            g = self._find_guild(gh)
             try:
                 image_mime = 'jpeg' if ext == 'jpg' else ext
                 payload = dict(
                     name=eh,
-                    image=(f"data:image/{image_mime};base64,"
-                           + base64.b64encode(b.getvalue()).decode('ascii'))
+                    image=f"data:image/{image_mime};base64,{base64.b64encode(b).decode('ascii')}"
                 )
                 logger.info('📸 Creating :%s: on "%s" (id %s)', eh, g['name'], g['id'])
                 self._request('POST', f"guilds/{g['id']}/emojis", json=payload)
             finally:
-                b.close()
                 del self._write_buffers[path]
                 self._invalidate_guild(g['id'])
 
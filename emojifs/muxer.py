@@ -18,6 +18,7 @@ You should have received a copy of the GNU General Public License
 along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """
 import bisect
+import dataclasses
 import errno
 import itertools
 import os
@@ -29,56 +30,110 @@ from logzero import logger
 import emojifs.utils as utils
 
 
+@dataclasses.dataclass(frozen=True)
+class _MuxState:
+    """Everything Muxer derives from its map, replaced all at once by remap()."""
+    map: dict  # path prefix -> fs, sorted by prefix
+    mountpoints: list
+    mount_tuples: list  # (prefix, len(prefix), fs), sorted by prefix, for _map_path's benefit
+    mount_prefixes: list  # just the prefixes of mount_tuples, for bisecting
+    intermediates: set  # directories above our mountpoints, which we serve ourselves
+    intermediate_children: dict  # intermediate -> names of its child directories
+
+
 class Muxer(fuse.LoggingMixIn, fuse.Operations):
-    def __init__(self, map):
+    def __init__(self, map, *, on_init=None):
         """Muxer is a FUSE filesystem compositor.  map should be a dict of path prefixes
         with values of FUSE implementations (e.g. Slack).  Muxer will dispatch operations
         to those filesystems based on path.
 
         The paths in map cannot be prefixes of one another.
+
+        If given, on_init is called with no arguments once the filesystem has been mounted.
         """
-        def pairwise(iterable):
-            "s -> (s0,s1), (s1,s2), (s2, s3), ..."
-            a, b = itertools.tee(iterable)
-            next(b, None)
-            return zip(a, b)
+        self._on_init = on_init
+        self.remap(map)
+
+    def remap(self, map):
+        """Replace our map (see __init__) with a new one.  Safe to call while mounted: each
+        operation sees either the old map or the new one in its entirety."""
         map = dict(sorted(map.items()))
-        self._map = map
-        self._mountpoints = list(map)
-        # self._intermediates really should be a tree, but that's no fun.
-        self._intermediates = set('/')
-        for item in self._mountpoints:
+        # Once sorted, any path that has another as a prefix sorts right after it (or after
+        # something else that also has it as a prefix), so checking neighbours is sufficient.
+        # This must be a plain string prefix check, not a per-path-component one: given /a and
+        # /a-b, _map_path would bisect /a/foo to /a-b.
+        prev = None
+        for key in map:
+            if prev is not None and key.startswith(prev):
+                raise ValueError(f"Muxer paths cannot be prefixes of one another: {prev} {key}")
+            prev = key
+        mountpoints = list(map)
+        # intermediates really should be a tree, but that's no fun.
+        intermediates = set('/')
+        for item in mountpoints:
             s = set((f"/{x}" for x in itertools.accumulate(filter(len, item.split('/')),
                                                            lambda *x: '/'.join(x))))
-            self._intermediates = self._intermediates.union(s)
-        self._intermediates = self._intermediates - set(self._mountpoints)
-        assert not any(b.startswith(a) for (a, b) in pairwise(map))
-        logger.info('🔧 Muxer created: map %s --> mountpoints %s intermediates %s', self._map,
-                    self._mountpoints, self._intermediates)
-
-    def _map_path(self, path):
+            intermediates |= s
+        intermediates.difference_update(mountpoints)
+        # For readdir: the names of each intermediate's child intermediates and mountpoints.
+        intermediate_children = {}
+        for inter in intermediates:
+            parent = inter if inter.endswith('/') else inter + '/'
+            intermediate_children[inter] = [
+                x[len(parent):]
+                for x in itertools.chain(intermediates, mountpoints)
+                if x.startswith(parent)             # by definition, child has parent's prefix
+                and '/' not in x[len(parent):]      # maxdepth=1
+                and x != '/']                       # don't serve '/' ('.' is always served)
+
+        mount_tuples = [(p, len(p), fs) for (p, fs) in map.items()]
+        # A single assignment, so that operations racing with us can't see a mix of old and new.
+        self._state = _MuxState(
+            map=map,
+            mountpoints=mountpoints,
+            mount_tuples=mount_tuples,
+            mount_prefixes=[t[0] for t in mount_tuples],
+            intermediates=intermediates,
+            intermediate_children=intermediate_children,
+        )
+        logger.info('🔧 Muxer created: map %s --> mountpoints %s intermediates %s', map,
+                    mountpoints, intermediates)
+
+    def invalidate_caches(self):
+        """Ask all our delegate filesystems to drop any cached data."""
+        for fs in self._state.map.values():
+            if hasattr(fs, 'invalidate_caches'):
+                fs.invalidate_caches()
+
+    def init(self, path):
+        if self._on_init:
+            self._on_init()
+
+    def _map_path(self, path, state=None):
         """Given a path, find the responsible FS in our map, and return a tuple of the path with
-        its prefix stripped and the delegated FS."""
-        def find_le(a, x):
-            'Find rightmost value less than or equal to x'
-            i = bisect.bisect_right(a, x)
-            if i:
-                return a[i-1]
+        its prefix stripped and the delegated FS.  Callers which also consult the rest of our
+        state should read self._state once and pass it in."""
+        if state is None:
+            state = self._state
+        # Find the rightmost prefix less than or equal to path.
+        i = bisect.bisect_right(state.mount_prefixes, path)
+        if not i:
             raise ValueError
-        candidate = find_le(self._mountpoints, path)
-        if not path.startswith(candidate):
+        (prefix, prefix_len, fs) = state.mount_tuples[i-1]
+        if not path.startswith(prefix):
             raise ValueError
-        if path == candidate:
-            return ('/', self._map[candidate])
-        return (path[len(candidate):], self._map[candidate])
+        if len(path) == prefix_len:
+            return ('/', fs)
+        return (path[prefix_len:], fs)
 
     # TODO: this should probably also passthrough init and destroy to all delegates
 
     # TODO: there must be a better way to do what follows...
 
     def getattr(self, path, *args, **kwargs):
+        state = self._state
         # Serve directory entries for our intermediates.
-        if path in self._intermediates:
+        if path in state.intermediates:
             return dict(
                 st_mode=stat.S_IFDIR | 0o555,
                 st_nlink=2,
@@ -87,82 +142,74 @@ class Muxer(fuse.LoggingMixIn, fuse.Operations):
             )
         # Delegate to mountpoints their / and below.
         try:
-            (path, fs) = self._map_path(path)
+            (path, fs) = self._map_path(path, state)
         except ValueError:
             raise fuse.FuseOSError(errno.ENOENT)
-        return getattr(fs, 'getattr')(path, *args, **kwargs)
+        return fs.getattr(path, *args, **kwargs)
 
     def listxattr(self, path, *args, **kwargs):
-        if path in self._intermediates:
+        state = self._state
+        if path in state.intermediates:
             return []
         try:
-            (path, fs) = self._map_path(path)
+            (path, fs) = self._map_path(path, state)
         except ValueError:
             raise fuse.FuseOSError(errno.ENOENT)
-        return getattr(fs, 'listxattr')(path, *args, **kwargs)
+        return fs.listxattr(path, *args, **kwargs)
 
     def getxattr(self, path, *args, **kwargs):
-        if path in self._intermediates:
+        state = self._state
+        if path in state.intermediates:
             raise fuse.FuseOSError(errno.ENODATA)
         try:
-            (path, fs) = self._map_path(path)
+            (path, fs) = self._map_path(path, state)
         except ValueError:
             raise fuse.FuseOSError(errno.ENOENT)
-        return getattr(fs, 'getxattr')(path, *args, **kwargs)
+        return fs.getxattr(path, *args, **kwargs)
 
     def readdir(self, path, *args, **kwargs):
+        state = self._state
         # For intermediate paths, synthesize all child intermediates and mountpoints.
-        if path in self._intermediates:
-            if not path.endswith('/'):
-                path = path + '/'
-
-            def find_children(ll):
-                return [x[len(path):] for x in ll       # remove the parent's prefix from child
-                        if x.startswith(path)           # by definition, child has parent's prefix
-                        and '/' not in x[len(path):]    # maxdepth=1
-                        and x != '/']                   # don't serve '/' ('.' is always served)
-
-            return (['.', '..']
-                    + find_children(self._intermediates)
-                    + find_children(self._mountpoints))
+        if path in state.intermediate_children:
+            return ['.', '..'] + state.intermediate_children[path]
         # Delegate to mountpoints their / and below.
-        (path, fs) = self._map_path(path)
-        return getattr(fs, 'readdir')(path, *args, **kwargs)
+        (path, fs) = self._map_path(path, state)
+        return fs.readdir(path, *args, **kwargs)
 
     def readlink(self, path, *args, **kwargs):
         (path, fs) = self._map_path(path)
-        return getattr(fs, 'readlink')(path, *args, **kwargs)
+        return fs.readlink(path, *args, **kwargs)
 
     def read(self, path, *args, **kwargs):
         (path, fs) = self._map_path(path)
-        return getattr(fs, 'read')(path, *args, **kwargs)
+        return fs.read(path, *args, **kwargs)
 
     def open(self, path, *args, **kwargs):
         (path, fs) = self._map_path(path)
-        return getattr(fs, 'open')(path, *args, **kwargs)
+        return fs.open(path, *args, **kwargs)
 
     def unlink(self, path, *args, **kwargs):
         (path, fs) = self._map_path(path)
-        return getattr(fs, 'unlink')(path, *args, **kwargs)
+        return fs.unlink(path, *args, **kwargs)
 
     def create(self, path, *args, **kwargs):
         (path, fs) = self._map_path(path)
-        return getattr(fs, 'create')(path, *args, **kwargs)
+        return fs.create(path, *args, **kwargs)
 
     def write(self, path, *args, **kwargs):
         (path, fs) = self._map_path(path)
-        return getattr(fs, 'write')(path, *args, **kwargs)
+        return fs.write(path, *args, **kwargs)
 
     def release(self, path, *args, **kwargs):
         (path, fs) = self._map_path(path)
-        return getattr(fs, 'release')(path, *args, **kwargs)
+        return fs.release(path, *args, **kwargs)
 
     def truncate(self, path, *args, **kwargs):
         (path, fs) = self._map_path(path)
-        return getattr(fs, 'truncate')(path, *args, **kwargs)
+        return fs.truncate(path, *args, **kwargs)
 
     def symlink(self, path, *args, **kwargs):
         (path, fs) = self._map_path(path)
-        return getattr(fs, 'symlink')(path, *args, **kwargs)
+        return fs.symlink(path, *args, **kwargs)
 
     # TODO other methods?  e.g. xattrs eventually
@@ -23,15 +23,18 @@ You should have received a copy of the GNU General Public License
 along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """
 
+import concurrent.futures
+import dataclasses
 import errno
+import functools
 import http.cookies
 import io
 import logging
 import re
 import stat
+import threading
 import time
 import urllib.parse
-from collections import defaultdict
 
 import cachetools
 import refuse.high as fuse
@@ -42,6 +45,27 @@ import emojifs.utils as utils
 import emojifs.constants as constants
 
 
+# The MIME subtype of a data:image/ URL, e.g. png.
+_DATA_URL_RE = re.compile(r'data:image/([^;,]+)[;,]')
+
+# For enumerate_tokens().
+_ALREADY_SIGNED_IN_TEAM_RE = re.compile(r"(https://[a-zA-Z0-9\-]+\.slack\.com)")
+_QUOTED_ALREADY_SIGNED_IN_TEAM_RE = re.compile(
+    r"&quot;url&quot;:&quot;(https:\\/\\/[a-zA-Z0-9\-]+\.slack\.com)")
+_SLACK_API_TOKEN_RE = re.compile(r"\"api_token\":\"(xox[a-zA-Z]-[a-zA-Z0-9-]+)\"")
+
+
+@dataclasses.dataclass
+class _EmojiIndex:
+    """All of a Slack's emoji, plus some things derived from them that we'd rather not recompute
+    on every FUSE operation."""
+    by_name: dict  # emoji name -> emoji API dict
+    by_filename: dict  # _emoji_to_filename(), also stored as e['_filename'] -> emoji API dict
+    min_ctime: int  # earliest and latest creation times of any emoji
+    max_ctime: int
+    filenames: list  # the directory listing, i.e. _emoji_to_filename() of each emoji
+
+
 class Slack(fuse.LoggingMixIn, fuse.Operations):
     """A FUSE filesystem implementation for an individual Slack team."""
     def __init__(self, token: str, *, real_sizes: bool = True, name: str = ''):
@@ -57,26 +81,28 @@ class Slack(fuse.LoggingMixIn, fuse.Operations):
         self._token = token
         self._real_sizes = real_sizes
         self._base_url = f"https://{name}.slack.com/api/" if name else 'https://api.slack.com/api/'
-        self._retry_after = {}  # URL -> time.time() after which it's ok to retry
+        self._retry_after = {}  # URL -> time.monotonic() after which it's ok to retry
+        self._limiter = utils.AdaptiveLimiter(8)  # everything we do goes to just one host
         self._write_buffers = {}  # path (not name!) -> BytesIO
+        self._write_sizes = {}  # path -> current size of its _write_buffers entry
         self.__cached_metadata = cachetools.TTLCache(maxsize=1, ttl=600)  # for _get_all_emoji()
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=8)  # for paging
 
         self._session = requests.Session()
+        self._session.mount('https://', utils.pooled_adapter())
         utils.set_user_agent(self._session.headers)
         self._session.headers['Authorization'] = f"Bearer {token}"
 
         # Our token should be usable for a single Slack.
         # To see if we have an admin token, first, we need our user ID.
-        r = self._request('GET', self._url('auth.test'))
-        j = r.json()
+        j = self._request('GET', self._url('auth.test'))
         self._user_id = j['user_id']
         self._base_url = j['url'] + 'api/'
         if not self.name:
             m = re.match(r'https://([^.]+)\.slack\.com/', j['url'])
             if m:
                 self.name = m[1]
-        r = self._request('GET', self._url('users.info'), params={'user': self._user_id})
-        j = r.json()
+        j = self._request('GET', self._url('users.info'), params={'user': self._user_id})
         self._user_json = j['user']
         # TODO: we thought we cared about is_admin, but of course is_admin is sufficient but not
         # necessary to upload emoji.
@@ -95,19 +121,25 @@ class Slack(fuse.LoggingMixIn, fuse.Operations):
 
     def _request(self, method, url, **kwargs):
         """Execute a request against our _session, respecting ratelimiting and raising if
-        the response isn't okay.  Retry on ratelimiting (after sleeping) but not on other error."""
+        the response isn't okay.  Retry on ratelimiting (after sleeping) but not on other error.
+        Returns the parsed JSON response (as we've had to parse it anyway to check it)."""
         # TODO: this is very close to, but not quite, Discord._request().
 
-        # Respect any ratelimiting on the given URL path
-        time.sleep(max(0, self._retry_after.get(url, 0) - time.time()))
-        resp = self._session.request(method, url, **kwargs)
-        if resp.status_code == 429:
-            self._retry_after[url] = time.time() + resp.headers.get('retry-after', 60)
-            logger.warn('Got ratelimited by Slack; retrying after %s seconds for %s',
-                        self._retry_after[url], url)
-            return self._request(method, url, **kwargs)
-        else:
+        while True:
+            # Respect any ratelimiting on the given URL path
+            time.sleep(max(0, self._retry_after.get(url, 0) - time.monotonic()))
+            with self._limiter:
+                resp = self._session.request(method, url, **kwargs)
+            if resp.status_code == 429:
+                self._limiter.ratelimited()
+                retry_after = float(resp.headers.get('retry-after', '60'))
+                self._retry_after[url] = time.monotonic() + retry_after
+                logger.warn('Got ratelimited by Slack; retrying after %s seconds for %s',
+                            retry_after, url)
+                continue
             resp.raise_for_status()
+            self._limiter.succeeded()
+            break
         j = resp.json()
         logger.debug('resp for %s to %s json: %s', method, url, j)
         if not j['ok']:
@@ -115,23 +147,24 @@ class Slack(fuse.LoggingMixIn, fuse.Operations):
             if j['error'] == 'no_permission':
                 raise fuse.FuseOSError(errno.EPERM)
         assert(j['ok'])
-        return resp
+        return j
 
     def _request_all_pages(self, method, url, *, _paged_key: str, **kwargs):
         """Wrapper around _request for paginated APIs.  Will fetch all pages and return an array
         of results.  Must be provided _paged_key as a special arg telling the name of the key that
         contains the API results you want.  All other kwargs follow the usual Requests conventions
-        (but it messes with params['page'] because it must).
+        (except that any params['page'] is overridden; the caller's params dict isn't modified).
         """
-        accum = []
-        pages_fetched = 0
-        j = defaultdict(lambda: defaultdict(lambda: 1))  # Thanks to Guru Ibynaf.
         params = kwargs.pop('params', {})
-        while pages_fetched < j['paging']['pages']:
-            params['page'] = pages_fetched
-            j = self._request(method, url, params=params, **kwargs).json()
-            accum.extend(j[_paged_key])
-            pages_fetched += 1
+        j = self._request(method, url, params={**params, 'page': 0}, **kwargs)
+        accum = list(j[_paged_key])
+        # Now that we know how many pages there are, fetch all the rest of them at once.
+        pages_total = j['paging']['pages']
+        futures = [self._executor.submit(self._request, method, url,
+                                         params={**params, 'page': page}, **kwargs)
+                   for page in range(1, pages_total)]
+        for f in futures:
+            accum.extend(f.result()[_paged_key])
         return accum
 
     def _upload_emoji(self, name: str, file):
@@ -166,19 +199,55 @@ class Slack(fuse.LoggingMixIn, fuse.Operations):
         @cachetools.cached(self.__cached_metadata)
         def real(self):
             r = self._request_all_pages('GET', self._url('emoji.adminList'), _paged_key='emoji')
-            return {e['name']: e for e in r}
+            if self._real_sizes:
+                # Fetch all the sizes in the background, so that the getattr() calls which
+                # surely follow (`ls -l`, file managers...) mostly hit get_content_length's cache.
+                urls = [e['url'] for e in r if e['url']]
+                threading.Thread(target=utils.prefetch_content_lengths, args=(urls,),
+                                 kwargs={'background': True},
+                                 name=f'prefetch-{self.name}', daemon=True).start()
+            for e in r:
+                # Parse these out of the URL once, rather than on every FUSE op which needs them.
+                e['_filename'] = self._emoji_to_filename(e)
+                e['_ext'] = e['_filename'].rpartition('.')[2] if e['_filename'] else None
+                e['_scheme'] = utils.url_scheme(e['url']) if e['url'] else None
+            created = [e['created'] for e in r]
+            by_filename = {e['_filename']: e for e in r}
+            return _EmojiIndex(
+                by_name={e['name']: e for e in r},
+                by_filename=by_filename,
+                min_ctime=min(created, default=0),
+                max_ctime=max(created, default=0),
+                filenames=list(by_filename),
+            )
         return real(self)
 
     def _invalidate_metadata(self):
         self.__cached_metadata.clear()
 
-    def _path_to_name(self, path: str) -> str:
+    def invalidate_caches(self):
+        """Clear all of our cached metadata."""
+        self._invalidate_metadata()
+
+    @staticmethod
+    @functools.lru_cache(maxsize=4096)
+    def _path_to_name(path: str) -> str:
         """Translates a path-like string (e.g. umactually.png, parrotdad.gif) to an
         emoji name (umactually, parrotdad).  Path-like strings are allow to omit a suffix."""
         rv = path.split('/', maxsplit=1)[-1].split('.')[0]
         logger.debug("mapped '%s' to emoji name %s", path, rv)
         return rv
 
+    def _path_to_emoji(self, path: str):
+        """Returns the emoji API dict for a path, or raises ENOENT."""
+        index = self._get_all_emoji()
+        # Usually we're asked about an exact filename we listed in readdir().
+        e = (index.by_filename.get(path.split('/', maxsplit=1)[-1])
+             or index.by_name.get(self._path_to_name(path)))
+        if e is None:
+            raise fuse.FuseOSError(errno.ENOENT)
+        return e
+
     def _emoji_to_filename(self, e, *, name: str = None) -> str:
         """Convert an emoji API dict to a pseudo-filename, including an extension."""
         real_name = e['name'] if not name else name
@@ -192,25 +261,25 @@ class Slack(fuse.LoggingMixIn, fuse.Operations):
             rv = f"{real_name}.{e['url'].rsplit('.', maxsplit=1)[-1]}"
             logger.debug('mapped %s to file %s', real_name, rv)
             return rv
-        elif e['url'].startswith('data:image/'):
+        m = _DATA_URL_RE.match(e['url'])
+        if m:
             # grab the extension (gif/png) from the data URL MIME type
-            extension = e['url'].split('data:image/')[1].split(';', maxsplit=1)[0]
-            rv = f"{real_name}.{extension}"
-            logger.debug('mapped %s to file %s (data:image/ URL)', e['url'], real_name, rv)
+            rv = f"{real_name}.{m[1]}"
+            logger.debug('mapped %s to file %s (data:image/ URL)', real_name, rv)
             return rv
 
     # Now, the main course: FUSE operations implementations.
 
     def getattr(self, path, fh):
-        emojis = self._get_all_emoji()
+        index = self._get_all_emoji()
 
         # TODO: if we don't set allow_others in our fuse_main invocation,
         #       the 0o555 is probably just confusing.
         if path == '/':
             return dict(
                 st_mode=stat.S_IFDIR | 0o555 | stat.S_IWUSR,
-                st_mtime=max([e['created'] for e in emojis.values()]),
-                st_ctime=min([e['created'] for e in emojis.values()]),
+                st_mtime=index.max_ctime,
+                st_ctime=index.min_ctime,
                 st_atime=time.time(),
                 st_nlink=2,
                 st_uid=utils.getuid(),
@@ -226,14 +295,10 @@ class Slack(fuse.LoggingMixIn, fuse.Operations):
                 st_nlink=1,
                 st_uid=utils.getuid(),
                 st_gid=utils.getgid(),
-                st_size=len(self._write_buffers[path].getbuffer())
+                st_size=self._write_sizes[path]
             )
 
-        name = self._path_to_name(path)
-        if name not in emojis:
-            raise fuse.FuseOSError(errno.ENOENT)
-
-        e = emojis[name]
+        e = self._path_to_emoji(path)
 
         return dict(
             st_mode=(stat.S_IFLNK if e['is_alias'] else stat.S_IFREG) | 0o444,
@@ -243,18 +308,15 @@ class Slack(fuse.LoggingMixIn, fuse.Operations):
             st_nlink=1,
             st_uid=utils.getuid(),
             st_gid=utils.getgid(),
-            st_size=(utils.get_content_length(e['url']) if self._real_sizes else 256*1024),
+            st_size=(utils.get_content_length(e['url'], e['_scheme']) if self._real_sizes
+                     else 256*1024),
         )
 
     def readdir(self, path, fh=None):
-        return ['.', '..'] + [self._emoji_to_filename(e) for e in self._get_all_emoji().values()]
+        return ['.', '..'] + self._get_all_emoji().filenames
 
     def readlink(self, path):
-        emojis = self._get_all_emoji()
-        name = self._path_to_name(path)
-        if name not in emojis:
-            raise fuse.FuseOSError(errno.ENOENT)
-        e = emojis[name]
+        e = self._path_to_emoji(path)
         if not e['is_alias']:
             raise fuse.FuseOSError(errno.EINVAL)
         # We don't 'deference' it ourselves using our metadata table, because it could be an alias
@@ -262,40 +324,30 @@ class Slack(fuse.LoggingMixIn, fuse.Operations):
         # This will represent it as a dangling symlink instead of throwing.
         # TODO: do something smart and/or reasonable about regular Unicode emoji
         #       (possibly, have another mountpoint for them?)
-        return self._emoji_to_filename(e, name=e['alias_for'])
+        return f"{e['alias_for']}.{e['_ext']}"
 
     def read(self, path, size, offset, fh):
+        # This has to return bytes: refuse ctypes.memmove()s out of it, which rejects memoryviews.
+        # Slicing out the whole file (the common case for emoji) doesn't copy anyway.
         if path in self._write_buffers:
             b = self._write_buffers[path]
             b.seek(offset)
             return b.read(size)
 
-        emojis = self._get_all_emoji()
-        name = self._path_to_name(path)
-        if name not in emojis:
-            raise fuse.FuseOSError(errno.ENOENT)
-        e = emojis[name]
-        b = utils.get_emoji_bytes(e['url'])
+        e = self._path_to_emoji(path)
+        b = utils.get_emoji_bytes(e['url'], e['_scheme'])
         return b[offset:offset+size]
 
     def listxattr(self, path):
         if path == '/' or path in self._write_buffers:
             return []
-        emojis = self._get_all_emoji()
-        name = self._path_to_name(path)
-        if name not in emojis:
-            raise fuse.FuseOSError(errno.ENOENT)
-
+        self._path_to_emoji(path)  # raises ENOENT if need be
         return [constants.URL_XATTR_NAME, constants.CREATEDBY_XATTR_NAME]
 
     def getxattr(self, path, attrname):
         if path == '/' or path in self._write_buffers:
             raise fuse.FuseOSError(errno.ENODATA)
-        emojis = self._get_all_emoji()
-        name = self._path_to_name(path)
-        e = emojis[name]
-        if name not in emojis:
-            raise fuse.FuseOSError(errno.ENOENT)
+        e = self._path_to_emoji(path)
         if attrname == constants.URL_XATTR_NAME:
             return bytes(e['url'], 'utf-8')
         elif attrname == constants.CREATEDBY_XATTR_NAME:
@@ -311,23 +363,23 @@ class Slack(fuse.LoggingMixIn, fuse.Operations):
 
     def unlink(self, path):
         # TODO: what about an unlink on a new file open in _write_buffers ?
-        emojis = self._get_all_emoji()
-        name = self._path_to_name(path)
-        if name not in emojis:
-            raise fuse.FuseOSError(errno.ENOENT)
-        self._delete_emoji(name)
+        e = self._path_to_emoji(path)
+        self._delete_emoji(e['name'])
 
     # TODO: both create() and symlink() need to check that the name being created is valid-ish
     #       (for now they'll just throw errors on release(), which may not reach the client)
 
     def create(self, path, mode, fi=None):
         self._write_buffers[path] = io.BytesIO()
+        self._write_sizes[path] = 0
         return 0
 
     def write(self, path, data, offset, fh):
         b = self._write_buffers[path]
         b.seek(offset)
-        return b.write(data)
+        rv = b.write(data)
+        self._write_sizes[path] = max(self._write_sizes[path], offset + rv)
+        return rv
 
     # This is where the write() magic actually happens.  We need to make a single POST call, with
     # a valid and complete image file, so it's the only place where it really can.
@@ -342,17 +394,17 @@ class Slack(fuse.LoggingMixIn, fuse.Operations):
             finally:
                 b.close()
                 del self._write_buffers[path]
+                del self._write_sizes[path]
 
     def truncate(self, path, length, fh=None):
         b = self._write_buffers[path]
         b.seek(0)
         b.truncate(length)
+        # BytesIO.truncate() can only shrink.
+        self._write_sizes[path] = min(self._write_sizes[path], length)
 
     def symlink(self, target_path, source_path):
-        emojis = self._get_all_emoji()
-        source = self._path_to_name(source_path)
-        if source not in emojis:
-            raise fuse.FuseOSError(errno.ENOENT)
+        source = self._path_to_emoji(source_path)['name']
         target = self._path_to_name(target_path)
         self._alias_emoji(source, target)
 
@@ -375,6 +427,8 @@ def enumerate_tokens(cookie: str):
             cookies['d'] = cookie
         cookies = dict(d=urllib.parse.quote(urllib.parse.unquote(cookies['d'].value)))
         sess = requests.Session()
+        # Each team is its own host, so keep enough per-host pools around for the fan-out below.
+        sess.mount('https://', utils.pooled_adapter(pool_connections=16))
         # a 'real' cookie jar was too annoying to figure out and seemed of dubious benefit anyway
         sess.headers['cookie'] = f"d={cookies['d']}"
         utils.set_user_agent(sess.headers)
@@ -382,27 +436,29 @@ def enumerate_tokens(cookie: str):
         # So, Slack helpfully lists all your logged-in teams.
         r = sess.get("https://emojifs-wasteland.slack.com")
         r.raise_for_status()
-        ALREADY_SIGNED_IN_TEAM_REGEX = r"(https://[a-zA-Z0-9\-]+\.slack\.com)"
-        QUOTED_ALREADY_SIGNED_IN_TEAM_REGEX = r"&quot;url&quot;:&quot;(https:\\/\\/[a-zA-Z0-9\-]+\.slack\.com)"
-        SLACK_API_TOKEN_REGEX = r"\"api_token\":\"(xox[a-zA-Z]-[a-zA-Z0-9-]+)\""
-        teams = (set(re.findall(ALREADY_SIGNED_IN_TEAM_REGEX, r.text))
+        teams = (set(_ALREADY_SIGNED_IN_TEAM_RE.findall(r.text))
                  | set(t.replace('\\', '')
-                       for t in re.findall(QUOTED_ALREADY_SIGNED_IN_TEAM_REGEX, r.text))
+                       for t in _QUOTED_ALREADY_SIGNED_IN_TEAM_RE.findall(r.text))
                  - set(['https://status.slack.com', 'https://api.slack.com']))
-        for team in teams:
+
+        def scrape(team):
             try:
                 r = sess.get(team + "/customize/emoji")
                 r.raise_for_status()
-                parsed = re.findall(SLACK_API_TOKEN_REGEX, r.text)
+                parsed = _SLACK_API_TOKEN_RE.findall(r.text)
                 logger.debug('👀 Found %s tokens from %s', len(parsed), team)
-                rv.extend(parsed)
+                return parsed
             except Exception:
                 logger.error("😖 Something went wrong when scraping token from %s", team, exc_info=1)
-                # then continue
+                return []  # then continue
+
+        if teams:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=min(16, len(teams))) as ex:
+                for parsed in ex.map(scrape, teams):
+                    rv.extend(parsed)
         return rv
     except Exception:
         logger.error("😖 Something went wrong when scraping login cookies", exc_info=True)
-    finally:
         return rv
 
 
@@ -1,10 +1,16 @@
 #!/usr/bin/env python3
 
 import base64
+import concurrent.futures
+import functools
+import hashlib
 import os
+import threading
 
 import cachetools
 import requests
+from logzero import logger
+from requests.adapters import Retry
 
 from emojifs import __repository__, __version__
 
@@ -14,45 +20,248 @@ def set_user_agent(x):
     x['User-Agent'] = f"emojifs/{__version__} (An Abomination, like Gecko) ({__repository__}) {x['User-Agent']}"
 
 
+def pooled_adapter(*, pool_connections: int = 8, pool_maxsize: int = 64):
+    """Returns a requests HTTPAdapter with a connection pool big enough to be shared by many
+    concurrent requests, which also retries idempotent requests on transient server errors.
+    429s are left to the caller, which knows how to back off from them properly; so are POSTs,
+    which aren't safe to blindly retry (e.g. Slack's emoji.add)."""
+    retries = Retry(total=5, backoff_factor=0.5, status_forcelist=[502, 503, 504],
+                    respect_retry_after_header=True)
+    return requests.adapters.HTTPAdapter(pool_connections=pool_connections,
+                                         pool_maxsize=pool_maxsize, max_retries=retries)
+
+
+# These can't change while we're running, so don't make a syscall on every getattr().
+_UID = os.getuid() if hasattr(os, 'getuid') else -1
+_GID = os.getgid() if hasattr(os, 'getgid') else -1
+
+
 def getuid():
     """Windows doesn't have os.getuid; WinFsp is happy with -1 though."""
-    return os.getuid() if hasattr(os, 'getuid') else -1
+    return _UID
 
 
 def getgid():
     """Windows doesn't have os.getgid; WinFsp is happy with -1 though."""
-    return os.getgid() if hasattr(os, 'getgid') else -1
+    return _GID
 
 
-@cachetools.cached(cachetools.LRUCache(maxsize=200))
-def get_emoji_bytes(url: str) -> bytes:
-    """Returns the bytes for a given emoji URL.  Handles HTTP(S) and data URLs."""
-    if url.startswith('http'):
-        r = _session.get(url)
-        r.raise_for_status()
-        return r.content
-    elif url.startswith('data:'):
-        (prefix, data) = url.split(',', maxsplit=1)
-        if not prefix.endswith('base64'):
-            raise ValueError
-        return base64.b64decode(data)
+class AdaptiveLimiter:
+    """A semaphore whose size adapts to the server, like a TCP congestion window: the limit is
+    halved whenever the server ratelimits us, and grows by one after every `increase_after`
+    successes in a row.  Use as a context manager around a request, and call ratelimited() or
+    succeeded() with its outcome."""
+
+    def __init__(self, initial: int = 8, *, maximum: int = 64, increase_after: int = 10):
+        self._cond = threading.Condition()
+        self._limit = initial
+        self._maximum = maximum
+        self._increase_after = increase_after
+        self._in_flight = 0
+        self._successes = 0
+
+    def __enter__(self):
+        with self._cond:
+            self._cond.wait_for(lambda: self._in_flight < self._limit)
+            self._in_flight += 1
+        return self
+
+    def __exit__(self, *exc_info):
+        with self._cond:
+            self._in_flight -= 1
+            self._cond.notify_all()
+
+    def ratelimited(self):
+        with self._cond:
+            self._limit = max(1, self._limit // 2)
+            self._successes = 0
+
+    def succeeded(self):
+        with self._cond:
+            self._successes += 1
+            if self._successes >= self._increase_after:
+                self._successes = 0
+                if self._limit < self._maximum:
+                    self._limit += 1
+                    self._cond.notify_all()
 
 
-@cachetools.cached(cachetools.LRUCache(maxsize=20000))
-def get_content_length(url: str) -> int:
-    """Returns the size of an emoji.  Handles HTTP(S) and data URLs."""
+def coalesced(func=None, *, key=cachetools.keys.hashkey, cache=None, lock=None):
+    """Decorator that makes concurrent calls to func with the same arguments share one call,
+    rather than each doing the same (expensive) work, so that many FUSE threads wanting the same
+    thing at once only make one HTTP request.  Calls are "the same" if key(*args, **kwargs) is.
+
+    If cache (a cachetools cache, guarded by lock) is given, results are also served from and
+    stored in it.  The leader stores its result before it stops being in flight, so there's no
+    window in which a caller can miss both and make a duplicate call."""
+    if func is None:
+        return functools.partial(coalesced, key=key, cache=cache, lock=lock)
+    in_flight_lock = threading.Lock()
+    in_flight = {}  # key(args) -> Future
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        k = key(*args, **kwargs)
+        with in_flight_lock:
+            if cache is not None:
+                with lock:
+                    try:
+                        return cache[k]
+                    except KeyError:
+                        pass
+            future = in_flight.get(k)
+            leader = future is None
+            if leader:
+                future = in_flight[k] = concurrent.futures.Future()
+        if not leader:
+            return future.result()
+        try:
+            rv = func(*args, **kwargs)
+            if cache is not None:
+                with lock:
+                    try:
+                        cache[k] = rv
+                    except ValueError:
+                        pass  # too large to cache at all
+            future.set_result(rv)
+            return rv
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with in_flight_lock:
+                del in_flight[k]
+    return wrapper
+
+
+def url_scheme(url: str):
+    """Returns 'http' (which includes HTTPS) or 'data' for an emoji URL we know how to fetch, or
+    None otherwise.  Callers which fetch the same URL often can compute this once up front."""
     if url.startswith('http'):
-        r = _session.head(url)
-        r.raise_for_status()
-        # Slack emojis are served over CloudFront which provides Content-Length.
-        return int(r.headers['Content-Length'])
+        return 'http'
     elif url.startswith('data:'):
-        (prefix, data) = url.split(',', maxsplit=1)
-        if not prefix.endswith('base64'):
-            raise ValueError
-        padding = data[-2:].count('=')
-        return int(3*len(data)/4 - padding)
+        return 'data'
+    return None
+
+
+def _url_key(url: str, scheme: str = None):
+    """A cache key for an emoji URL.  data: URLs can be tens of KB, so use a digest instead."""
+    if (scheme or url_scheme(url)) == 'data':
+        digest = hashlib.blake2b(url.encode(), digest_size=16).digest()
+        return cachetools.keys.hashkey('data', digest)
+    return cachetools.keys.hashkey(url)
+
+
+def _data_url_payload(url: str) -> str:
+    (prefix, _, data) = url.partition(',')
+    if not prefix.endswith('base64'):
+        raise ValueError
+    return data
+
+
+def _fetch_http_bytes(url: str) -> bytes:
+    r = _session.get(url)
+    r.raise_for_status()
+    return r.content
+
+
+def _fetch_data_bytes(url: str) -> bytes:
+    return base64.b64decode(_data_url_payload(url))
+
+
+def _fetch_http_length(url: str) -> int:
+    r = _session.head(url)
+    r.raise_for_status()
+    # Slack emojis are served over CloudFront which provides Content-Length.
+    return int(r.headers['Content-Length'])
+
+
+def _fetch_data_length(url: str) -> int:
+    data = _data_url_payload(url)
+    padding = data[-2:].count('=')
+    return int(3*len(data)/4 - padding)
+
+
+_BYTES_FETCHERS = {'http': _fetch_http_bytes, 'data': _fetch_data_bytes}
+_LENGTH_FETCHERS = {'http': _fetch_http_length, 'data': _fetch_data_length}
+
+
+# Bounded by total size rather than by count: a few hundred big GIFs can add up to a lot.
+_bytes_cache = cachetools.TTLCache(maxsize=64*1024*1024, ttl=3600, getsizeof=len)
+_bytes_lock = threading.Lock()
+# Locked because prefetch_content_lengths calls get_content_length from many threads at once.
+_length_cache = cachetools.TTLCache(maxsize=20000, ttl=3600)
+_length_lock = threading.Lock()
+
+
+def invalidate_caches():
+    """Drop all the emoji bytes and sizes cached by get_emoji_bytes and get_content_length."""
+    with _bytes_lock:
+        _bytes_cache.clear()
+    with _length_lock:
+        _length_cache.clear()
+
+
+def invalidate_url(url: str):
+    """Drop any cached bytes and size for the given emoji URL, e.g. once it's been replaced."""
+    k = _url_key(url)
+    with _bytes_lock:
+        _bytes_cache.pop(k, None)
+    with _length_lock:
+        _length_cache.pop(k, None)
+
+
+@coalesced(key=_url_key, cache=_bytes_cache, lock=_bytes_lock)
+def get_emoji_bytes(url: str, scheme: str = None) -> bytes:
+    """Returns the bytes for a given emoji URL.  Handles HTTP(S) and data URLs.
+    scheme, if given, must be url_scheme(url)."""
+    fetch = _BYTES_FETCHERS.get(scheme or url_scheme(url))
+    if not fetch:
+        raise ValueError(f"Don't know how to fetch {url[:64]}")
+    return fetch(url)
+
+
+@coalesced(key=_url_key, cache=_length_cache, lock=_length_lock)
+def get_content_length(url: str, scheme: str = None) -> int:
+    """Returns the size of an emoji.  Handles HTTP(S) and data URLs.
+    scheme, if given, must be url_scheme(url)."""
+    fetch = _LENGTH_FETCHERS.get(scheme or url_scheme(url))
+    if not fetch:
+        raise ValueError(f"Don't know how to fetch {url[:64]}")
+    return fetch(url)
+
+
+def prefetch_content_lengths(urls, *, background: bool = False) -> dict:
+    """Concurrently call get_content_length on all the given URLs, warming its cache, and return
+    a dict of URL -> size.  URLs that fail are logged and left out.
+
+    Pass background=True if nobody is waiting on the result, so that a big background prefetch
+    queues on its own pool instead of in front of callers who are (e.g. a readdir)."""
+    def fetch(url):
+        try:
+            return get_content_length(url)
+        except Exception:
+            logger.debug('Failed to prefetch size of %s', url, exc_info=True)
+            return None
+
+    urls = list(urls)
+    sizes = (_background_executor if background else _executor).map(fetch, urls)
+    return {url: sz for (url, sz) in zip(urls, sizes) if sz is not None}
 
 
+# Shared by all our callers, so that however many Slacks and Discords are prefetching at once,
+# they don't open more connections than our _session will pool.  Background prefetches get a
+# small pool of their own: they can queue thousands of HEADs at once, and a FIFO queue shared with
+# blocking callers would make those wait behind all of them.  The cost is that the background pool
+# alone fetches more slowly than the two combined would.
+# (Their threads are only started on first use, which is after any daemonizing fork().)
+_executor = concurrent.futures.ThreadPoolExecutor(max_workers=min(48, (os.cpu_count() or 1) * 4),
+                                                  thread_name_prefix='emojifs-prefetch')
+_background_executor = concurrent.futures.ThreadPoolExecutor(
+    max_workers=16, thread_name_prefix='emojifs-background-prefetch')
 _session = requests.Session()
+# Big enough for prefetch_content_lengths not to overflow it and open new connections.
+# Slack serves emoji from a single host, so give it a pool of its own.
+_session.mount('https://', pooled_adapter())
+_session.mount('https://emoji.slack-edge.com/', pooled_adapter(pool_connections=1))
 set_user_agent(_session.headers)
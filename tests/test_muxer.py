@@ -0,0 +1,77 @@
+import errno
+
+import pytest
+
+try:
+    import refuse.high as fuse
+    from emojifs.muxer import Muxer
+except (ImportError, OSError):  # refuse raises OSError when libfuse isn't installed
+    pytest.skip('refuse/libfuse unavailable', allow_module_level=True)
+
+
+A, B, C = object(), object(), object()
+
+
+@pytest.mark.parametrize('paths', [('/a', '/a-b'), ('/a', '/a/b'), ('/a/b', '/a')])
+def test_rejects_prefixes(paths):
+    with pytest.raises(ValueError):
+        Muxer({p: A for p in paths})
+
+
+def test_remap_rejection_keeps_old_map():
+    m = Muxer({'/slack': A})
+    with pytest.raises(ValueError):
+        m.remap({'/a': B, '/a-b': C})
+    assert m._map_path('/slack') == ('/', A)
+
+
+def test_empty_map():
+    m = Muxer({})
+    assert m.readdir('/') == ['.', '..']
+    assert m.getattr('/')['st_nlink'] == 2
+    with pytest.raises(ValueError):
+        m._map_path('/anything')
+    with pytest.raises(fuse.FuseOSError) as e:
+        m.getattr('/anything')
+    assert e.value.errno == errno.ENOENT
+
+
+def test_intermediate_children_for_nested_mounts():
+    m = Muxer({'/slack/foo': A, '/slack/bar': B, '/discord': C})
+    assert m._state.intermediates == {'/', '/slack'}
+    assert sorted(m._state.intermediate_children['/']) == ['discord', 'slack']
+    assert sorted(m._state.intermediate_children['/slack']) == ['bar', 'foo']
+    assert sorted(m.readdir('/slack')) == ['.', '..', 'bar', 'foo']
+
+
+def test_map_path():
+    m = Muxer({'/slack/foo': A, '/slack/bar': B, '/discord': C})
+    assert m._map_path('/slack/foo') == ('/', A)
+    assert m._map_path('/discord') == ('/', C)
+    assert m._map_path('/slack/bar/party.gif') == ('/party.gif', B)
+    assert m._map_path('/discord/guild/blob.png') == ('/guild/blob.png', C)
+    with pytest.raises(ValueError):
+        m._map_path('/nope')
+
+
+def test_remap_replaces_map():
+    m = Muxer({'/slack': A})
+    m.remap({'/discord': B})
+    assert m._map_path('/discord') == ('/', B)
+    with pytest.raises(ValueError):
+        m._map_path('/slack')
+    assert m._state.intermediate_children['/'] == ['discord']
+
+
+def test_remap_to_shorter_map_while_operations_race():
+    m = Muxer({'/slack/a': A, '/slack/b': B, '/slack/c': C})
+    old = m._state  # as read by an operation that started before the remap
+    m.remap({'/slack/a': A})
+    # The racing operation keeps using the old map consistently...
+    assert m._map_path('/slack/c/x.png', old) == ('/x.png', C)
+    # ...while new ones see only the new map.
+    with pytest.raises(ValueError):
+        m._map_path('/slack/c/x.png')
+    with pytest.raises(fuse.FuseOSError) as e:
+        m.getattr('/slack/c/x.png')
+    assert e.value.errno == errno.ENOENT
@@ -0,0 +1,215 @@
+import threading
+import time
+
+import cachetools
+import pytest
+
+from emojifs import utils
+
+
+def _run_concurrently(release, *fns):
+    """Start each of fns in its own thread, give them a moment to all block, then set release
+    and wait for them all to finish."""
+    threads = []
+    for fn in fns:
+        t = threading.Thread(target=fn)
+        t.start()
+        threads.append(t)
+        time.sleep(0.05)
+    release.set()
+    for t in threads:
+        t.join()
+
+
+def test_coalesced_shares_one_call():
+    calls = []
+    release = threading.Event()
+
+    @utils.coalesced
+    def f(x):
+        calls.append(x)
+        release.wait(5)
+        return x * 2
+
+    results = []
+    _run_concurrently(release, *[lambda: results.append(f(21))] * 5)
+    assert calls == [21]
+    assert results == [42] * 5
+
+
+def test_coalesced_followers_get_leaders_exception():
+    calls = []
+    release = threading.Event()
+
+    @utils.coalesced
+    def f(x):
+        calls.append(x)
+        release.wait(5)
+        raise ValueError(x)
+
+    errors = []
+
+    def call():
+        try:
+            f('boom')
+        except ValueError as e:
+            errors.append(e)
+
+    _run_concurrently(release, *[call] * 4)
+    assert calls == ['boom']
+    assert len(errors) == 4
+    assert all(e is errors[0] for e in errors)
+
+
+def test_coalesced_forgets_finished_calls():
+    calls = []
+
+    @utils.coalesced
+    def f(x):
+        calls.append(x)
+        if x == 'bad':
+            raise ValueError(x)
+        return x
+
+    # Nothing is left in flight, so sequential calls (after success or failure) each run anew.
+    assert f('good') == 'good'
+    assert f('good') == 'good'
+    for _ in range(2):
+        with pytest.raises(ValueError):
+            f('bad')
+    assert calls == ['good', 'good', 'bad', 'bad']
+
+
+def test_coalesced_distinguishes_arguments():
+    calls = []
+    release = threading.Event()
+
+    @utils.coalesced
+    def f(x):
+        calls.append(x)
+        release.wait(5)
+        return x
+
+    _run_concurrently(release, lambda: f(1), lambda: f(2))
+    assert sorted(calls) == [1, 2]
+
+
+def test_coalesced_with_cache():
+    calls = []
+    cache = cachetools.LRUCache(maxsize=4, getsizeof=len)
+
+    @utils.coalesced(cache=cache, lock=threading.Lock())
+    def f(x):
+        calls.append(x)
+        return x
+
+    assert f('ab') == 'ab'
+    assert f('ab') == 'ab'
+    # Too big for the cache, so not stored, but still returned.
+    assert f('abcdef') == 'abcdef'
+    assert f('abcdef') == 'abcdef'
+    assert calls == ['ab', 'abcdef', 'abcdef']
+
+
+def test_get_content_length_coalesces_across_call_signatures(monkeypatch):
+    """The size prefetcher passes only the URL, while Slack.getattr also passes the scheme;
+    concurrent calls of both kinds must still share a single HEAD."""
+    url = 'https://example.invalid/coalesce-signatures.png'
+    calls = []
+    release = threading.Event()
+
+    def fake_length(u):
+        calls.append(u)
+        release.wait(5)
+        return 1234
+
+    monkeypatch.setitem(utils._LENGTH_FETCHERS, 'http', fake_length)
+    results = []
+    _run_concurrently(release,
+                      lambda: results.append(utils.get_content_length(url)),
+                      lambda: results.append(utils.get_content_length(url, 'http')))
+    assert calls == [url]
+    assert results == [1234, 1234]
+
+
+def test_adaptive_limiter_halves_on_ratelimit_but_not_below_one():
+    limiter = utils.AdaptiveLimiter(8)
+    limiter.ratelimited()
+    assert limiter._limit == 4
+    for _ in range(5):
+        limiter.ratelimited()
+    assert limiter._limit == 1
+
+
+def test_adaptive_limiter_grows_after_a_run_of_successes():
+    limiter = utils.AdaptiveLimiter(2, maximum=3, increase_after=3)
+    for _ in range(2):
+        limiter.succeeded()
+    assert limiter._limit == 2
+    # A ratelimit resets the run of successes.
+    limiter.ratelimited()
+    limiter.succeeded()
+    limiter.succeeded()
+    assert limiter._limit == 1
+    limiter.succeeded()
+    assert limiter._limit == 2
+    for _ in range(6):
+        limiter.succeeded()
+    assert limiter._limit == 3  # capped at maximum
+
+
+def test_adaptive_limiter_bounds_concurrency():
+    limiter = utils.AdaptiveLimiter(2)
+    lock = threading.Lock()
+    in_flight = [0]
+    peak = [0]
+
+    def work():
+        with limiter:
+            with lock:
+                in_flight[0] += 1
+                peak[0] = max(peak[0], in_flight[0])
+            time.sleep(0.02)
+            with lock:
+                in_flight[0] -= 1
+
+    threads = [threading.Thread(target=work) for _ in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert peak[0] == 2
+
+
+def test_invalidate_caches_drops_sizes(monkeypatch):
+    url = 'https://example.invalid/invalidate.png'
+    sizes = iter([1, 2])
+    monkeypatch.setitem(utils._LENGTH_FETCHERS, 'http', lambda u: next(sizes))
+    assert utils.get_content_length(url) == 1
+    assert utils.get_content_length(url) == 1
+    utils.invalidate_caches()
+    assert utils.get_content_length(url) == 2
+
+
+def test_background_prefetch_does_not_delay_foreground(monkeypatch):
+    release = threading.Event()
+
+    def fake_length(u):
+        if '/bg' in u:
+            release.wait(5)
+        return len(u)
+
+    monkeypatch.setitem(utils._LENGTH_FETCHERS, 'http', fake_length)
+    bg_urls = [f'https://example.invalid/bg{i}.png' for i in range(100)]
+    bg = threading.Thread(target=utils.prefetch_content_lengths, args=(bg_urls,),
+                          kwargs={'background': True})
+    bg.start()
+    try:
+        time.sleep(0.05)
+        fg_urls = ['https://example.invalid/fg0.png', 'https://example.invalid/fg1.png']
+        start = time.monotonic()
+        assert utils.prefetch_content_lengths(fg_urls) == {u: len(u) for u in fg_urls}
+        assert time.monotonic() - start < 1
+    finally:
+        release.set()
+        bg.join()